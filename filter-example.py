@@ -5,9 +5,16 @@
 # channels list
 # 
 import sys, json
-metadata = json.loads(sys.argv[1])
 
-metadata['author'] = "The Great and Powerful Oz"
+def transform(metadata):
+    metadata['author'] = "The Great and Powerful Oz"
+    return metadata
 
-print json.dumps(metadata)
+if len(sys.argv) > 1:
+    print json.dumps(transform(json.loads(sys.argv[1])))
+else:
+    # With filterstream set: a JSON line in, a JSON line out, per commit.
+    for line in iter(sys.stdin.readline, ""):
+        print json.dumps(transform(json.loads(line)))
+        sys.stdout.flush()
 # end
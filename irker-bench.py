@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+#
+# Local benchmarks for irkerd.  Nothing here talks to the outside
+# world: the IRC servers are stand-ins listening on localhost.
+# Probably only of interest to irker developers.
+#
+# usage: irker-bench.py [--irkerd PATH] [--engine ENGINE] BENCHMARK
+#
+# Give --irkerd the path of an older irkerd to get a before-and-after
+# comparison.
+#
+# Benchmarks:
+#
+# connect  - Time delivery to a healthy server while another request
+#            is stuck connecting to a server that never completes
+#            the TCP handshake.
+# dispatch - Time Dispatcher.dispatch() for one server with thousands
+#            of channels, both to channels it already carries and to
+#            new ones that force scavenging.  Nothing is transmitted.
+# parse    - Time Irker.handle() on request lines drawn from a few
+#            dozen channel URLs, with Dispatcher stubbed out, so only
+#            parsing, validation and routing to servers are measured.
+# tls      - Time repeated connects to a local ircs:// server, first
+#            with a fresh TLS context each time and then with the
+#            shared one and session resumption.  Needs openssl(1) to
+#            make a throwaway certificate.
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+def load_irkerd(path):
+    "Import an irkerd script as a module."
+    try:  # Python 3
+        import importlib.machinery
+        import importlib.util
+        loader = importlib.machinery.SourceFileLoader("irkerd", path)
+        spec = importlib.util.spec_from_loader("irkerd", loader)
+        module = importlib.util.module_from_spec(spec)
+        loader.exec_module(module)
+        return module
+    except ImportError:  # Python 2
+        import imp
+        return imp.load_source("irkerd", path)
+
+def make_irker(irkerd, engine):
+    "Build and start an Irker instance, whatever its vintage."
+    kwargs = dict(nick_template="bench%03d", nick_needs_number=True)
+    if hasattr(irkerd, "ENGINES"):
+        kwargs["engine"] = engine
+    irker = irkerd.Irker(**kwargs)
+    irker.thread_launch()
+    return irker
+
+def listener(backlog=128):
+    "Return a listening socket on an unused localhost port."
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(backlog)
+    return sock
+
+def blackhole():
+    "Return a listening socket, and its fillers, that connects hang on."
+    # Never accept, and fill the accept queue so that the kernel
+    # drops further SYNs on the floor and connect() just waits.
+    sock = listener(backlog=0)
+    address = sock.getsockname()
+    fillers = []
+    while True:
+        filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        filler.settimeout(0.5)
+        try:
+            filler.connect(address)
+        except socket.timeout:
+            break
+        fillers.append(filler)
+    return (sock, fillers)
+
+class FakeIRCServer(object):
+    "Just enough of an IRC server to log irkerd in and record PRIVMSGs."
+    def __init__(self, ssl_context=None):
+        self.ssl_context = ssl_context
+        self.sock = listener()
+        self.port = self.sock.getsockname()[1]
+        self.received = []
+        self.cond = threading.Condition()
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+    def accept(self):
+        while True:
+            (client, _addr) = self.sock.accept()
+            thread = threading.Thread(target=self.serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+    def serve(self, client):
+        if self.ssl_context is not None:
+            try:
+                client = self.ssl_context.wrap_socket(client, server_side=True)
+            except (ssl.SSLError, socket.error):
+                client.close()
+                return
+        nick = "*"
+        try:
+            for line in client.makefile("rb"):
+                words = line.decode("utf-8").rstrip("\r\n").split(" ", 2)
+                if words[0] == "NICK":
+                    nick = words[1]
+                elif words[0] == "USER":
+                    client.sendall((":fake 001 %s :Welcome\r\n"
+                                    % nick).encode())
+                elif words[0] == "PRIVMSG":
+                    with self.cond:
+                        self.received.append((time.time(), words[1],
+                                              words[2]))
+                        self.cond.notify_all()
+                elif words[0] == "QUIT":
+                    break
+        except (socket.error, ssl.SSLError):
+            # Clients that hang up without a TLS close_notify, say
+            pass
+        finally:
+            client.close()
+    def wait_for(self, count, timeout):
+        "Wait until count PRIVMSGs have arrived; return whether they did."
+        deadline = time.time() + timeout
+        with self.cond:
+            while len(self.received) < count and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return len(self.received) >= count
+
+def request(url, text):
+    return '{"to":"%s","privmsg":"%s"}' % (url, text)
+
+def bench_connect(irkerd, args):
+    healthy = FakeIRCServer()
+    (stalled, _fillers) = blackhole()
+    irker = make_irker(irkerd, args.engine)
+    start = time.time()
+    irker.handle(request("irc://127.0.0.1:%d/stalled"
+                         % stalled.getsockname()[1], "never delivered"))
+    # Give the stalled handshake a head start.
+    time.sleep(0.2)
+    for i in range(args.messages):
+        irker.handle(request("irc://127.0.0.1:%d/healthy" % healthy.port,
+                             "message %d" % i))
+    delivered = healthy.wait_for(args.messages, args.timeout)
+    if healthy.received:
+        first = healthy.received[0][0] - start
+        last = healthy.received[-1][0] - start
+        print("first delivery after %.3fs, last (%d of %d) after %.3fs" % (
+            first, len(healthy.received), args.messages, last))
+    if not delivered:
+        print("FAIL: healthy server starved for %ds by a stalled one"
+              % args.timeout)
+        return 1
+    return 0
+
+def bench_dispatch(irkerd, args):
+    if not hasattr(irkerd.Dispatcher, "touch"):
+        print("FAIL: this irkerd has no dispatcher indices to measure")
+        return 1
+    # The event loop is never started, so nothing is ever connected
+    # or sent; the connections just accumulate queued traffic.
+    kwargs = dict(nick_template="bench%03d", nick_needs_number=True)
+    irker = irkerd.Irker(engine="events", **kwargs)
+    target = irkerd.Target("irc://irc.example.net/bench")
+    dispatcher = irkerd.Dispatcher(irker, target=target, **kwargs)
+    channels = ["#chan%d" % i for i in range(args.channels)]
+    start = time.time()
+    for channel in channels:
+        dispatcher.dispatch(channel, "hello", "")
+    elapsed = time.time() - start
+    print("%d channels spread over %d connections: %.1fus per new channel"
+          % (len(channels), len(dispatcher.connections),
+             elapsed / len(channels) * 1e6))
+    count = 20000
+    picks = [random.choice(channels) for _ in range(count)]
+    start = time.time()
+    for channel in picks:
+        dispatcher.dispatch(channel, "hello", "")
+    elapsed = time.time() - start
+    print("%d messages to known channels: %.1fus per message"
+          % (count, elapsed / count * 1e6))
+    # Make every channel old enough to scavenge.
+    irkerd.CHANNEL_TTL = -1
+    fresh = ["#fresh%d" % i for i in range(count)]
+    start = time.time()
+    for channel in fresh:
+        dispatcher.dispatch(channel, "hello", "")
+    elapsed = time.time() - start
+    print("%d messages to new channels, each scavenging: %.1fus per message"
+          % (count, elapsed / count * 1e6))
+    print("still %d connections" % len(dispatcher.connections))
+    return 0
+
+class NullDispatcher(object):
+    "Stands in for irkerd's Dispatcher, and throws all messages away."
+    def __init__(self, *args, **kwargs):
+        pass
+    def dispatch(self, *args, **kwargs):
+        pass
+    def live(self):
+        return True
+    def last_xmit(self):
+        return 0
+
+def bench_parse(irkerd, args):
+    kwargs = dict(nick_template="bench%03d", nick_needs_number=True)
+    if hasattr(irkerd, "ENGINES"):
+        kwargs["engine"] = "threads"	# so handle() delivers inline
+    irker = irkerd.Irker(**kwargs)
+    irkerd.Dispatcher = NullDispatcher
+    urls = ["irc://irc.example.net/project%d" % i for i in range(args.urls)]
+    lines = [request(random.choice(urls), "commit %d" % i)
+             for i in range(args.requests)]
+    start = time.time()
+    for line in lines:
+        irker.handle(line)
+    elapsed = time.time() - start
+    print("%d requests to %d URLs: %.0f requests/second"
+          % (len(lines), len(urls), len(lines) / elapsed))
+    return 0
+
+def make_certificate(directory):
+    "Make a self-signed certificate for 127.0.0.1; return its file name."
+    certfile = os.path.join(directory, "bench.pem")
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+         "-days", "1", "-subj", "/CN=127.0.0.1",
+         "-addext", "subjectAltName=IP:127.0.0.1",
+         "-keyout", certfile, "-out", certfile],
+        stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    return certfile
+
+def time_connects(irkerd, irker, target, certfile, count, fresh):
+    "Return (median connect time, number resumed) for count connects."
+    times = []
+    resumed = 0
+    for i in range(count):
+        if fresh:
+            irker.irc.tls = irkerd.TLSCache()
+        connection = irker.irc.newserver()
+        connection.context = None	# No irkerd Connection behind it
+        start = time.time()
+        connection.connect(target, "bench%03d" % i, cafile=certfile)
+        times.append(time.time() - start)
+        if getattr(connection.socket, "session_reused", False):
+            resumed += 1
+        # Read the welcome, and with it any TLS 1.3 session tickets.
+        connection.consume()
+        connection.disconnect()
+    times.sort()
+    return (times[len(times) // 2], resumed)
+
+def bench_tls(irkerd, args):
+    directory = tempfile.mkdtemp()
+    try:
+        certfile = make_certificate(directory)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(certfile)
+        server = FakeIRCServer(ssl_context=server_context)
+        irker = irkerd.Irker(nick_template="bench%03d", nick_needs_number=True)
+        target = irkerd.Target("ircs://127.0.0.1:%d/bench" % server.port)
+        runs = [("cold", True), ("warm", False)]
+        if not hasattr(irkerd, "TLSCache"):
+            runs = [("every", False)]
+        for (name, fresh) in runs:
+            try:
+                (median, resumed) = time_connects(
+                    irkerd, irker, target, certfile, args.connects, fresh)
+            except irkerd.IRCServerConnectionError as e:
+                print("FAIL: %s" % e)
+                return 1
+            print("%s connects: median %.2fms, %d of %d resumed"
+                  % (name, median * 1e3, resumed, args.connects))
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+BENCHMARKS = {
+    "connect": bench_connect,
+    "dispatch": bench_dispatch,
+    "parse": bench_parse,
+    "tls": bench_tls,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local benchmarks for irkerd.")
+    parser.add_argument(
+        '--irkerd', metavar='PATH',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "irkerd"),
+        help='irkerd script to benchmark')
+    parser.add_argument(
+        '--engine', metavar='ENGINE', default='events',
+        help='irkerd engine to use, if it has a choice')
+    parser.add_argument(
+        '--messages', metavar='N', type=int, default=3,
+        help='number of messages to deliver')
+    parser.add_argument(
+        '--channels', metavar='N', type=int, default=5000,
+        help='number of channels per server')
+    parser.add_argument(
+        '--urls', metavar='N', type=int, default=50,
+        help='number of distinct target URLs')
+    parser.add_argument(
+        '--requests', metavar='N', type=int, default=100000,
+        help='number of requests to parse')
+    parser.add_argument(
+        '--connects', metavar='N', type=int, default=50,
+        help='number of TLS connects')
+    parser.add_argument(
+        '--timeout', metavar='SECONDS', type=int, default=30,
+        help='how long to wait for delivery')
+    parser.add_argument(
+        'benchmark', choices=sorted(BENCHMARKS.keys()))
+    args = parser.parse_args()
+    irkerd = load_irkerd(args.irkerd)
+    sys.exit(BENCHMARKS[args.benchmark](irkerd, args))
+
+if __name__ == '__main__':
+    main()
+
+# end
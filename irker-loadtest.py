@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+#
+# Load test for irkerd's delivery path.  Starts an irkerd, points it
+# at stand-in IRC servers on localhost, feeds it requests through its
+# TCP or UDP listener at a steady rate, and reports throughput,
+# latency from request to PRIVMSG, and the daemon's CPU time and peak
+# memory.  Nothing here talks to the outside world.
+#
+# usage: irker-loadtest.py [options]
+#
+# The irkerd under test listens on the usual port, so don't run this
+# alongside a live one.  Remember that irkerd paces each server
+# connection to about one message a second after a short burst; to
+# push more traffic through, spread it over more servers and channels
+# (and use a low --chanlimit, so each server needs more connections).
+#
+# The stand-in servers can be told to misbehave: reject nicks, kick,
+# PING, hang up, or be slow to read.  See --help.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+IRKERD_PORT = 6659
+
+class Stats(object):
+    "Deliveries seen by all the stand-in servers."
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.delivered = set()
+        self.duplicates = 0
+        self.latencies = []
+        self.last = None
+        self.counts = {"connects": 0, "kicks": 0, "hangups": 0,
+                       "pongs": 0, "collisions": 0}
+    def deliver(self, seq, stamp):
+        now = time.time()
+        with self.cond:
+            if seq in self.delivered:
+                self.duplicates += 1
+                return
+            self.delivered.add(seq)
+            self.latencies.append(now - stamp)
+            self.last = now
+            self.cond.notify_all()
+    def bump(self, name):
+        with self.cond:
+            self.counts[name] += 1
+    def wait_for(self, count, timeout):
+        "Wait until count messages have arrived; return whether they did."
+        deadline = time.time() + timeout
+        with self.cond:
+            while len(self.delivered) < count and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return len(self.delivered) >= count
+
+class Session(object):
+    "One client connection to a stand-in server."
+    def __init__(self, server, client):
+        self.server = server
+        self.client = client
+        self.lock = threading.Lock()
+        self.nick = "*"
+        self.nick_tries = 0
+        self.user = False
+        self.registered = False
+        self.joined = set()
+        self.privmsgs = 0
+        self.per_channel = {}
+        self.closed = False
+    def send(self, line):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.client.sendall((line + "\r\n").encode("utf-8"))
+            except socket.error:
+                self.closed = True
+    def hangup(self):
+        with self.lock:
+            self.closed = True
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    def welcome(self):
+        args = self.server.args
+        self.registered = True
+        self.send(":fake 001 %s :Welcome to the load test" % self.nick)
+        self.send(":fake 005 %s CHANLIMIT=#:%d TARGMAX=PRIVMSG:%d "
+                  ":are supported by this server"
+                  % (self.nick, args.chanlimit, args.targmax))
+    def pinger(self):
+        interval = self.server.args.ping_every
+        while not self.closed:
+            time.sleep(interval)
+            self.send("PING :fake")
+    def serve(self):
+        args = self.server.args
+        stats = self.server.stats
+        stats.bump("connects")
+        if args.ping_every:
+            thread = threading.Thread(target=self.pinger)
+            thread.daemon = True
+            thread.start()
+        for line in self.client.makefile("rb"):
+            if self.closed:
+                break
+            if args.slow:
+                time.sleep(args.slow)
+            line = line.decode("utf-8", "replace").rstrip("\r\n")
+            (command, _, rest) = line.partition(" ")
+            if command == "NICK":
+                self.nick_tries += 1
+                if self.nick_tries <= args.nick_collisions:
+                    stats.bump("collisions")
+                    self.send(":fake 433 * %s :Nickname is already in use"
+                              % rest)
+                    continue
+                self.nick = rest
+                if self.user and not self.registered:
+                    self.welcome()
+            elif command == "USER":
+                self.user = True
+                if self.nick_tries > args.nick_collisions:
+                    self.welcome()
+            elif command == "JOIN":
+                channel = rest.split(" ")[0]
+                if len(self.joined) >= args.chanlimit:
+                    self.send(":fake 405 %s %s :You have joined too many "
+                              "channels" % (self.nick, channel))
+                else:
+                    self.joined.add(channel)
+            elif command == "PART":
+                self.joined.discard(rest.split(" ")[0])
+            elif command == "PONG":
+                stats.bump("pongs")
+            elif command == "PRIVMSG":
+                (destinations, _, text) = rest.partition(" :")
+                words = text.split(" ")
+                for channel in destinations.split(","):
+                    if len(words) == 3 and words[0] == "load":
+                        stats.deliver(int(words[1]), float(words[2]))
+                    self.kick(channel)
+                self.privmsgs += 1
+                if args.disconnect_every \
+                       and self.privmsgs % args.disconnect_every == 0:
+                    stats.bump("hangups")
+                    self.hangup()
+                    break
+            elif command == "QUIT":
+                break
+        self.hangup()
+        self.client.close()
+    def kick(self, channel):
+        "Kick the client out of a channel every so often, if asked to."
+        every = self.server.args.kick_every
+        if not every:
+            return
+        count = self.per_channel[channel] = self.per_channel.get(channel, 0) + 1
+        if count % every == 0:
+            self.server.stats.bump("kicks")
+            self.joined.discard(channel)
+            self.send(":op!op@fake KICK %s %s :load test" % (channel, self.nick))
+
+class FakeIRCServer(object):
+    "A scriptable stand-in IRC server on a localhost port."
+    def __init__(self, args, stats):
+        self.args = args
+        self.stats = stats
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+    def accept(self):
+        while True:
+            (client, _addr) = self.sock.accept()
+            thread = threading.Thread(target=Session(self, client).serve)
+            thread.daemon = True
+            thread.start()
+
+def start_irkerd(args):
+    "Launch the daemon under test and wait for its listener."
+    command = [sys.executable, args.irkerd, "-H", "127.0.0.1",
+               "-l", os.devnull, "-n", "load%03d"]
+    if args.engine:
+        command += ["-E", args.engine]
+    command += args.irkerd_arg
+    proc = subprocess.Popen(command)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit("irkerd exited with status %d" % proc.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", IRKERD_PORT), 1).close()
+            return proc
+        except socket.error:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit("irkerd didn't start listening")
+
+def generate(args, servers):
+    "Send requests at a steady rate; return how many were sent."
+    urls = ["irc://127.0.0.1:%d/#load%d" % (server.port, channel)
+            for server in servers for channel in range(args.channels)]
+    total = int(args.rate * args.duration)
+    interval = 1.0 / args.rate
+    tcp = None
+    if args.transport != "udp":
+        tcp = socket.create_connection(("127.0.0.1", IRKERD_PORT))
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = time.time()
+    for seq in range(total):
+        delay = start + seq * interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        line = json.dumps({"to": urls[seq % len(urls)],
+                           "privmsg": "load %d %.6f" % (seq, time.time())})
+        if args.transport == "udp" \
+               or (args.transport == "both" and seq % 2):
+            udp.sendto(line.encode("utf-8"), ("127.0.0.1", IRKERD_PORT))
+        else:
+            tcp.sendall((line + "\n").encode("utf-8"))
+    if tcp is not None:
+        tcp.close()
+    return (total, start)
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def report(args, stats, total, start, usage):
+    with stats.cond:
+        delivered = len(stats.delivered)
+        latencies = sorted(stats.latencies)
+        last = stats.last
+    print("requests:   %d over %ds via %s, to %d servers x %d channels"
+          % (total, args.duration, args.transport, args.servers,
+             args.channels))
+    print("delivered:  %d (%d lost, %d duplicates)"
+          % (delivered, total - delivered, stats.duplicates))
+    if latencies:
+        elapsed = last - start
+        print("throughput: %.1f messages/second over %.1fs"
+              % (delivered / elapsed, elapsed))
+        print("latency:    p50 %.3fs, p99 %.3fs, max %.3fs"
+              % (percentile(latencies, 0.5), percentile(latencies, 0.99),
+                 latencies[-1]))
+    print("servers:    %s" % ", ".join("%d %s" % (v, k) for (k, v)
+                                       in sorted(stats.counts.items())))
+    cpu = usage.ru_utime + usage.ru_stime
+    print("irkerd CPU: %.2fs user, %.2fs system (%.1f%% of one core)"
+          % (usage.ru_utime, usage.ru_stime,
+             100 * cpu / max(time.time() - start, 1e-6)))
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    rss = usage.ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    print("irkerd RSS: %.1fMB peak" % (rss / 1024.0))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test irkerd against stand-in IRC servers.")
+    parser.add_argument(
+        '--irkerd', metavar='PATH',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "irkerd"),
+        help='irkerd script to test')
+    parser.add_argument(
+        '--engine', metavar='ENGINE',
+        help='irkerd engine to use, if it has a choice')
+    parser.add_argument(
+        '--irkerd-arg', metavar='ARG', action='append', default=[],
+        help='extra argument for irkerd (may be repeated)')
+    parser.add_argument(
+        '--servers', metavar='N', type=int, default=2,
+        help='number of stand-in IRC servers')
+    parser.add_argument(
+        '--channels', metavar='N', type=int, default=10,
+        help='number of channels on each server')
+    parser.add_argument(
+        '--rate', metavar='N', type=float, default=10,
+        help='requests per second, spread over all the channels')
+    parser.add_argument(
+        '--duration', metavar='SECONDS', type=int, default=10,
+        help='how long to send requests for')
+    parser.add_argument(
+        '--transport', choices=['tcp', 'udp', 'both'], default='tcp',
+        help='irkerd listener to send requests to')
+    parser.add_argument(
+        '--drain', metavar='SECONDS', type=int, default=60,
+        help='how long to wait for delivery after the last request')
+    parser.add_argument(
+        '--chanlimit', metavar='N', type=int, default=10,
+        help='channels each connection may join (CHANLIMIT)')
+    parser.add_argument(
+        '--targmax', metavar='N', type=int, default=4,
+        help='targets per PRIVMSG (TARGMAX)')
+    parser.add_argument(
+        '--nick-collisions', metavar='N', type=int, default=0,
+        help='reject the first N nicks on each connection with 433')
+    parser.add_argument(
+        '--kick-every', metavar='N', type=int, default=0,
+        help='kick irkerd from a channel after every N messages to it')
+    parser.add_argument(
+        '--ping-every', metavar='SECONDS', type=float, default=0,
+        help='PING each connection this often')
+    parser.add_argument(
+        '--disconnect-every', metavar='N', type=int, default=0,
+        help='hang up on a connection after every N PRIVMSGs')
+    parser.add_argument(
+        '--slow', metavar='SECONDS', type=float, default=0,
+        help='pause this long before reading each line from irkerd')
+    args = parser.parse_args()
+
+    stats = Stats()
+    servers = [FakeIRCServer(args, stats) for _ in range(args.servers)]
+    proc = start_irkerd(args)
+    try:
+        (total, start) = generate(args, servers)
+        stats.wait_for(total, args.drain)
+    finally:
+        if proc.poll() is None:
+            os.kill(proc.pid, signal.SIGTERM)
+    (_pid, _status, usage) = os.wait4(proc.pid, 0)
+    report(args, stats, total, start, usage)
+    if len(stats.delivered) < total:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# end
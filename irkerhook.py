@@ -19,10 +19,33 @@
 default_server = "localhost"
 IRKER_PORT = 6659
 
+# Largest batch of notifications to send irker as one request line.
+# irkerd reads at most 8192 bytes of a UDP datagram.
+TCP_BATCH_MAX = 65536
+UDP_BATCH_MAX = 8000
+
 # The default service used to turn your web-view URL into a tinyurl so it
 # will take up less space on the IRC notification line.
 default_tinyifier = "http://tinyurl.com/api-create.php?url="
 
+# Where to remember web-view checks and tinyified URLs between runs, so
+# that pushing the same commits again (say, to a mirror) doesn't repeat
+# the lookups.  Entries are kept for URL_CACHE_TTL seconds, and only
+# the newest URL_CACHE_MAX of them.
+default_urlcache = "~/.cache/irkerhook/urls.json"
+URL_CACHE_TTL = 30 * 24 * 60 * 60
+URL_CACHE_MAX = 5000
+
+# Web lookups for a push run URL_WORKERS at a time, each allowed
+# URL_TIMEOUT seconds.  Whatever isn't done after URL_BUDGET seconds
+# in all ships with the plain web-view URL.
+URL_WORKERS = 4
+URL_TIMEOUT = 5
+URL_BUDGET = 15
+
+# With filterstream set, how long the filter may take over each commit.
+FILTER_TIMEOUT = 10
+
 # Map magic urlprefix values to actual URL prefixes.
 urlprefixmap = {
     "viewcvs": "http://%(host)s/viewcvs/%(repo)s?view=revision&revision=",
@@ -39,7 +62,8 @@ default_channels = "irc://chat.freenode.net/#commits"
 
 version = "2.13"
 
-import os, sys, commands, socket, urllib, subprocess, locale, datetime, re
+import os, sys, commands, socket, urllib2, subprocess, locale, datetime, re
+import smtplib, threading, time, Queue, select
 from pipes import quote as shellquote
 try:
     import simplejson as json	# Faster, also makes us Python-2.5-compatible
@@ -49,6 +73,22 @@ except ImportError:
 def do(command):
     return unicode(commands.getstatusoutput(command)[1], locale.getlocale()[1] or 'UTF-8').encode(locale.getlocale()[1] or 'UTF-8')
 
+def git(arguments, stdin=None):
+    "Run git without a shell, optionally feeding it input; return its output."
+    process = subprocess.Popen(["git"] + arguments,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=open(os.devnull, "w"))
+    output = process.communicate(stdin)[0]
+    return unicode(output, locale.getlocale()[1] or 'UTF-8').encode(locale.getlocale()[1] or 'UTF-8')
+
+def git_bool(value):
+    "Canonicalize a git boolean the way git config --bool does."
+    if value is None or value.lower() in ("true", "yes", "on", "1"):
+        return "true"
+    elif value.lower() in ("false", "no", "off", "0", ""):
+        return "false"
+    return value
+
 class Commit:
     def __init__(self, extractor, commit):
         "Per-commit data."
@@ -62,38 +102,145 @@ class Commit:
         self.url = None
         self.author_date = None
         self.commit_date = None
-        self.__dict__.update(extractor.__dict__)
+        # Underscored extractor attributes are bookkeeping, not commit data.
+        for (key, value) in extractor.__dict__.items():
+            if not key.startswith("_"):
+                setattr(self, key, value)
+    def webview(self):
+        "Return the URL of a web view of this commit, or None."
+        if self.urlprefix.lower() == "none":
+            return None
+        urlprefix = urlprefixmap.get(self.urlprefix, self.urlprefix)
+        return (urlprefix % self.__dict__) + self.commit
     def __unicode__(self):
         "Produce a notification string from this commit."
-        if self.urlprefix.lower() == "none":
+        webview = self.webview()
+        if webview is None:
             self.url = ""
         else:
-            urlprefix = urlprefixmap.get(self.urlprefix, self.urlprefix)
-            webview = (urlprefix % self.__dict__) + self.commit
-            try:
-                if urllib.urlopen(webview).getcode() == 404:
-                    raise IOError
-                if self.tinyifier and self.tinyifier.lower() != "none":
-                    try:
-                        # Didn't get a retrieval error or 404 on the web
-                        # view, so try to tinyify a reference to it.
-                        self.url = open(urllib.urlretrieve(self.tinyifier + webview)[0]).read()
-                        try:
-                            self.url = self.url.decode('UTF-8')
-                        except UnicodeError:
-                            pass
-                    except IOError:
-                        self.url = webview
-                else:
-                    self.url = webview
-            except IOError:
-                self.url = ""
+            self.url = (urlcache or URLCache(None)).url(webview, self.tinyifier)
         res = self.template % self.__dict__
         return unicode(res, 'UTF-8') if not isinstance(res, unicode) else res
 
+def lookup(webview, tinyifier):
+    "Check a web view exists and tinyify it; return (URL, whether to cache)."
+    try:
+        urllib2.urlopen(webview, timeout=URL_TIMEOUT).close()
+    except urllib2.HTTPError, e:
+        if e.code == 404:
+            return ("", False)
+    except (IOError, ValueError):
+        return ("", False)
+    if not tinyifier or tinyifier.lower() == "none":
+        return (webview, True)
+    try:
+        # Didn't get a retrieval error or 404 on the web
+        # view, so try to tinyify a reference to it.
+        url = urllib2.urlopen(tinyifier + webview, timeout=URL_TIMEOUT).read()
+    except (IOError, ValueError):
+        return (webview, False)
+    try:
+        url = url.decode('UTF-8')
+    except UnicodeError:
+        pass
+    return (url, True)
+
+class URLCache:
+    "Web-view checks and tinyified URLs, remembered across runs."
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.resolved = {}
+        self.dirty = False
+        if path:
+            try:
+                entries = json.load(open(path))
+            except (IOError, ValueError):
+                entries = {}
+            if not isinstance(entries, dict):
+                entries = {}
+            # Keep only [timestamp, url] entries; a damaged cache costs
+            # some lookups, not the notifications.
+            for (key, entry) in entries.items():
+                if isinstance(entry, list) and len(entry) == 2 \
+                       and isinstance(entry[0], (int, long, float)) \
+                       and isinstance(entry[1], basestring):
+                    self.entries[key] = entry
+    def cached(self, key):
+        "Return the cached URL for a lookup, if it's fresh enough."
+        entry = self.entries.get(key)
+        if entry and time.time() - entry[0] < URL_CACHE_TTL:
+            return entry[1]
+        return None
+    def resolve(self, lookups):
+        "Do the uncached (webview, tinyifier) lookups, several at a time."
+        lookups = [(webview, tinyifier or "") for (webview, tinyifier) in lookups]
+        pending = Queue.Queue()
+        for (webview, tinyifier) in set(lookups):
+            if self.cached(tinyifier + webview) is None:
+                pending.put((webview, tinyifier))
+        def worker():
+            while True:
+                try:
+                    (webview, tinyifier) = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                self.resolved[tinyifier + webview] = lookup(webview, tinyifier)
+        workers = []
+        for _ in range(min(URL_WORKERS, pending.qsize())):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+        deadline = time.time() + URL_BUDGET
+        for thread in workers:
+            thread.join(max(0, deadline - time.time()))
+        # Over budget: whatever is left ships with the plain web view.
+        for (webview, tinyifier) in lookups:
+            if tinyifier + webview not in self.resolved \
+                   and self.cached(tinyifier + webview) is None:
+                self.resolved[tinyifier + webview] = (webview, False)
+    def url(self, webview, tinyifier):
+        "Return the URL to ship for a web view."
+        tinyifier = tinyifier or ""
+        key = tinyifier + webview
+        if key not in self.resolved:
+            url = self.cached(key)
+            if url is not None:
+                return url
+            self.resolved[key] = lookup(webview, tinyifier)
+        (url, cacheable) = self.resolved[key]
+        if cacheable and self.path:
+            self.entries[key] = [time.time(), url]
+            self.dirty = True
+        return url
+    def save(self):
+        "Write the cache back, dropping stale and surplus entries."
+        if not self.path or not self.dirty:
+            return
+        now = time.time()
+        entries = [(v[0], k, v) for (k, v) in self.entries.items()
+                   if now - v[0] < URL_CACHE_TTL]
+        entries.sort(reverse=True)
+        entries = dict((k, v) for (_, k, v) in entries[:URL_CACHE_MAX])
+        # Write and rename, so concurrent runs never see half a file.
+        temp = "%s.%d" % (self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            json.dump(entries, open(temp, "w"))
+            os.rename(temp, self.path)
+        except (IOError, OSError), e:
+            sys.stderr.write("irkerhook.py: could not save URL cache: %s\n"
+                             % e)
+
+# The URL cache for this run, set up by ship_all()
+urlcache = None
+
 class GenericExtractor:
     "Generic class for encapsulating data from a VCS."
-    booleans = ["tcp"]
+    booleans = ["tcp", "batch", "filterstream"]
     numerics = ["maxchannels"]
     strings = ["email"]
     def __init__(self, arguments):
@@ -103,7 +250,9 @@ class GenericExtractor:
         # These aren't really repo data but they belong here anyway...
         self.email = None
         self.tcp = True
+        self.batch = False
         self.tinyifier = default_tinyifier
+        self.urlcache = default_urlcache
         self.server = None
         self.channels = None
         self.maxchannels = 0
@@ -112,6 +261,7 @@ class GenericExtractor:
         self.host = socket.getfqdn()
         self.cialike = None
         self.filtercmd = None
+        self.filterstream = False
         # Color highlighting is disabled by default.
         self.color = None
         self.bold = self.green = self.blue = self.yellow = ""
@@ -197,6 +347,9 @@ class GenericExtractor:
             self.channels = default_channels % self.__dict__
         if self.color and self.color.lower() != "none":
             self.activate_color(self.color)
+    def prefetch(self, commit_ids):
+        "Gather data for several commits at once, where the VCS allows it."
+        pass
 
 def has(dirname, paths):
     "Test for existence of a list of paths."
@@ -217,25 +370,44 @@ class GitExtractor(GenericExtractor):
                has(dirname, ["HEAD", "refs", "objects"])
     def __init__(self, arguments):
         GenericExtractor.__init__(self, arguments)
-        # Get all global config variables
-        self.project = do("git config --get irker.project")
-        self.repo = do("git config --get irker.repo")
-        self.server = do("git config --get irker.server")
-        self.channels = do("git config --get irker.channels")
-        self.email = do("git config --get irker.email")
-        self.tcp = do("git config --bool --get irker.tcp")
+        # Get all global config variables, with a single git config run.
+        # With -z each entry is "name\nvalue\0", or just "name\0" for
+        # a bare boolean; as with git config --get, the last one wins.
+        config = {}
+        for entry in git(["config", "-z", "--get-regexp",
+                          r"^(irker\..*|core\.bare)$"]).split("\0"):
+            if entry:
+                (name, newline, value) = entry.partition("\n")
+                config[name] = value if newline else None
+        def get(name):
+            return config.get(name) or ""
+        self.project = get("irker.project")
+        self.repo = get("irker.repo")
+        self.server = get("irker.server")
+        self.channels = get("irker.channels")
+        self.email = get("irker.email")
+        if "irker.tcp" in config:
+            self.tcp = git_bool(config["irker.tcp"])
+        else:
+            self.tcp = ""
+        if "irker.batch" in config:
+            self.batch = git_bool(config["irker.batch"])
         self.template = '%(bold)s%(project)s:%(reset)s %(green)s%(author)s%(reset)s %(repo)s:%(yellow)s%(branch)s%(reset)s * %(bold)s%(rev)s%(reset)s / %(bold)s%(files)s%(reset)s: %(logmsg)s %(brown)s%(url)s%(reset)s'
-        self.tinyifier = do("git config --get irker.tinyifier") or default_tinyifier
-        self.color = do("git config --get irker.color")
-        self.urlprefix = do("git config --get irker.urlprefix") or "gitweb"
-        self.cialike = do("git config --get irker.cialike")
-        self.filtercmd = do("git config --get irker.filtercmd")
+        self.tinyifier = get("irker.tinyifier") or default_tinyifier
+        self.urlcache = get("irker.urlcache") or default_urlcache
+        self.color = get("irker.color")
+        self.urlprefix = get("irker.urlprefix") or "gitweb"
+        self.cialike = get("irker.cialike")
+        self.filtercmd = get("irker.filtercmd")
+        if "irker.filterstream" in config:
+            self.filterstream = git_bool(config["irker.filterstream"])
         # These are git-specific
         self.refname = do("git symbolic-ref HEAD 2>/dev/null")
-        self.revformat = do("git config --get irker.revformat")
+        self.revformat = get("irker.revformat")
+        self._metadata = {}
         # The project variable defaults to the name of the repository toplevel.
         if not self.project:
-            bare = do("git config --bool --get core.bare")
+            bare = git_bool(config.get("core.bare", "false"))
             if bare.lower() == "true":
                 keyfile = "HEAD"
             else:
@@ -256,34 +428,72 @@ class GitExtractor(GenericExtractor):
     def head(self):
         "Return a symbolic reference to the tip commit of the current branch."
         return "HEAD"
+    def prefetch(self, commit_ids):
+        "Read the metadata for a batch of commits with one git log run."
+        commit_ids = [c for c in commit_ids if c not in self._metadata]
+        if not commit_ids:
+            return
+        # Resolve the IDs, which may be tags or other revision names,
+        # so the git log output can be matched up with them.
+        hashes = git(["cat-file", "--batch-check=%(objectname)"],
+                     "".join(c + "^{commit}\n" for c in commit_ids)).split("\n")
+        hashes = dict(zip(commit_ids, hashes))
+        wanted = [h for h in set(hashes.values()) if " " not in h]
+        if not wanted:
+            return
+        # Design choice: for git we ship only the first message line, which is
+        # conventionally supposed to be a summary of the commit.  Under
+        # other VCSes a different choice may be appropriate.  The file
+        # list matches git diff-tree -r --name-only: nothing for merges
+        # or the root commit, and renames are a deletion plus an addition.
+        log = git(["-c", "log.showroot=false", "log", "--no-walk", "--stdin",
+                   "--no-color", "--no-renames", "--name-only",
+                   "--pretty=format:%x1e%H%x00%an%x00%ae%x00%s%x00%ai%x00%ci%x00"],
+                  "".join(h + "\n" for h in wanted))
+        data = {}
+        for record in log.split("\x1e")[1:]:
+            fields = record.split("\0")
+            if len(fields) != 7:
+                continue
+            files = [f for f in fields[6].split("\n") if f]
+            data[fields[0]] = fields[1:6] + [" ".join(files)]
+        # Compute descriptions for the revisions.  With --always, git
+        # describe falls back to an abbreviated hash instead of failing,
+        # so that one undescribable commit can't spoil the batch.
+        descriptions = {}
+        if self.revformat not in ('raw', 'short'):
+            output = git(["describe", "--always"] + wanted).split("\n")
+            for (h, description) in zip(wanted, output):
+                if not h.startswith(description):
+                    descriptions[h] = description
+        for (commit_id, h) in hashes.items():
+            if h in data:
+                self._metadata[commit_id] = data[h] + [descriptions.get(h, "")]
     def commit_factory(self, commit_id):
         "Make a Commit object holding data for a specified commit ID."
+        self.prefetch([commit_id])
+        if commit_id not in self._metadata:
+            sys.stderr.write("irkerhook.py: no such commit %s\n" % commit_id)
+            raise SystemExit(1)
         commit = Commit(self, commit_id)
         commit.branch = re.sub(r"^refs/[^/]*/", "", self.refname)
+        (commit.author_name, commit.mail, commit.logmsg,
+         commit.author_date, commit.commit_date,
+         commit.files, description) = self._metadata[commit_id]
         # Compute a description for the revision
         if self.revformat == 'raw':
             commit.rev = commit.commit
         elif self.revformat == 'short':
             commit.rev = ''
         else: # self.revformat == 'describe'
-            commit.rev = do("git describe %s 2>/dev/null" % shellquote(commit.commit))
+            commit.rev = description
         if not commit.rev:
             commit.rev = commit.commit[:12]
-        # Extract the meta-information for the commit
-        commit.files = do("git diff-tree -r --name-only " + shellquote(commit.commit))
-        commit.files = " ".join(commit.files.strip().split("\n")[1:])
-        # Design choice: for git we ship only the first message line, which is
-        # conventionally supposed to be a summary of the commit.  Under
-        # other VCSes a different choice may be appropriate.
-        commit.author_name, commit.mail, commit.logmsg = \
-            do("git log -1 '--pretty=format:%an%n%ae%n%s' " + shellquote(commit.commit)).split("\n")
         # This discards the part of the author's address after @.
         # Might be be nice to ship the full email address, if not
         # for spammers' address harvesters - getting this wrong
         # would make the freenode #commits channel into harvester heaven.
         commit.author = commit.mail.split("@")[0]
-        commit.author_date, commit.commit_date = \
-            do("git log -1 '--pretty=format:%ai|%ci' " + shellquote(commit.commit)).split("|")
         return commit
 
 class SvnExtractor(GenericExtractor):
@@ -357,8 +567,10 @@ class HgExtractor(GenericExtractor):
         self.channels = ui.config('irker', 'channels')
         self.email = ui.config('irker', 'email')
         self.tcp = str(ui.configbool('irker', 'tcp'))  # converted to bool again in do_overrides
+        self.batch = str(ui.configbool('irker', 'batch'))
         self.template = '%(bold)s%(project)s:%(reset)s %(green)s%(author)s%(reset)s %(repo)s:%(yellow)s%(branch)s%(reset)s * %(bold)s%(rev)s%(reset)s / %(bold)s%(files)s%(reset)s: %(logmsg)s %(brown)s%(url)s%(reset)s'
         self.tinyifier = ui.config('irker', 'tinyifier') or default_tinyifier
+        self.urlcache = ui.config('irker', 'urlcache') or default_urlcache
         self.color = ui.config('irker', 'color')
         self.urlprefix = (ui.config('irker', 'urlprefix') or
                           ui.config('web', 'baseurl') or '')
@@ -367,6 +579,7 @@ class HgExtractor(GenericExtractor):
             self.urlprefix = self.urlprefix.rstrip('/') + '/rev/'
         self.cialike = ui.config('irker', 'cialike')
         self.filtercmd = ui.config('irker', 'filtercmd')
+        self.filterstream = str(ui.configbool('irker', 'filterstream'))
         if not self.project:
             self.project = os.path.basename(self.repository.root.rstrip('/'))
         self.do_overrides()
@@ -403,8 +616,7 @@ def hg_hook(ui, repo, **kwds):
     if start != end:
         # changegroup with multiple commits, so we generate a notification
         # for each one
-        for rev in range(start, end):
-            ship(extractor, rev, False)
+        ship_all(extractor, range(start, end), False)
     else:
         ship(extractor, kwds['node'], False)
 
@@ -415,12 +627,76 @@ extractors = [GitExtractor, HgExtractor, SvnExtractor]
 
 # VCS-dependent code ends here
 
-def ship(extractor, commit, debug):
-    "Ship a notification for the specified commit."
+class FilterError(Exception):
+    pass
+
+class FilterProcess:
+    "A filtercmd started once per run, filtering a JSON line per commit."
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(shellquote(command), shell=True,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.buffer = ""
+    def filter(self, data):
+        "Send the filter one line, and return the line it sends back."
+        pending = data + "\n"
+        infd = self.process.stdin.fileno()
+        outfd = self.process.stdout.fileno()
+        deadline = time.time() + FILTER_TIMEOUT
+        # Keep reading while writing, so neither side can fill a pipe
+        # and wedge the other.
+        while "\n" not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise FilterError("timed out after %ds" % FILTER_TIMEOUT)
+            writers = []
+            if pending:
+                writers = [infd]
+            (readable, writable, _) = select.select([outfd], writers, [],
+                                                     remaining)
+            try:
+                if writable:
+                    written = os.write(infd, pending[:select.PIPE_BUF])
+                    pending = pending[written:]
+                if readable:
+                    chunk = os.read(outfd, 65536)
+                    if not chunk:
+                        raise FilterError("exited")
+                    self.buffer += chunk
+            except OSError, e:
+                raise FilterError("failed: %s" % e.strerror)
+        (line, _, self.buffer) = self.buffer.partition("\n")
+        return line
+    def close(self):
+        "Tell the filter we're done, and reap it."
+        self.process.stdin.close()
+        deadline = time.time() + 1
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+def filtered(extractor, commit, coprocess=None):
+    "Gather the metadata for the specified commit, and filter it."
     metadata = extractor.commit_factory(commit)
 
     # This is where we apply filtering
-    if extractor.filtercmd:
+    if coprocess:
+        try:
+            data = coprocess.filter(json.dumps(metadata.__dict__))
+        except FilterError, e:
+            sys.stderr.write("irkerhook.py: filter %s %s\n"
+                             % (coprocess.command, e))
+            coprocess.close()
+            raise SystemExit(1)
+        try:
+            metadata.__dict__.update(json.loads(data))
+        except ValueError:
+            sys.stderr.write("irkerhook.py: could not decode JSON: %s\n" % data)
+            raise SystemExit(1)
+    elif extractor.filtercmd:
         cmd = '%s %s' % (shellquote(extractor.filtercmd),
                          shellquote(json.dumps(metadata.__dict__)))
         data = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
@@ -429,6 +705,10 @@ def ship(extractor, commit, debug):
         except ValueError:
             sys.stderr.write("irkerhook.py: could not decode JSON: %s\n" % data)
             raise SystemExit(1)
+    return metadata
+
+def notification(extractor, metadata):
+    "Build the irker request for a commit's filtered metadata."
 
     # Rewrite the file list if too long. The objective here is only
     # to be easier on the eyes.
@@ -458,43 +738,105 @@ def ship(extractor, commit, debug):
     channels = metadata.channels.split(",")
     if extractor.maxchannels != 0:
         channels = channels[:extractor.maxchannels]
+    return {"to": channels, "privmsg": privmsg}
 
-    # Ready to ship.
-    message = json.dumps({"to": channels, "privmsg": privmsg})
-    if debug:
-        print message
-    elif channels:
-        try:
-            if extractor.email:
-                # We can't really figure out what our SF username is without
-                # exploring our environment. The mail pipeline doesn't care
-                # about who sent the mail, other than being from sourceforge.
-                # A better way might be to simply call mail(1)
-                sender = "irker@users.sourceforge.net"
-                msg = """From: %(sender)s
+def batches(requests, limit):
+    "Pack requests into JSON arrays, each no longer than limit if possible."
+    def pack(batch):
+        # A lone request goes as itself, which any irkerd understands.
+        if len(batch) == 1:
+            return batch[0]
+        return "[" + ", ".join(batch) + "]"
+    batch, size = [], 0
+    for request in requests:
+        request = json.dumps(request)
+        # Two bytes of brackets for a new batch, or of ", " for an addition
+        if batch and size + len(request) + 2 > limit:
+            yield pack(batch)
+            batch, size = [], 0
+        batch.append(request)
+        size += len(request) + 2
+    if batch:
+        yield pack(batch)
+
+def deliver(extractor, requests):
+    "Send requests to irker over a single connection."
+    if extractor.email:
+        # We can't really figure out what our SF username is without
+        # exploring our environment. The mail pipeline doesn't care
+        # about who sent the mail, other than being from sourceforge.
+        # A better way might be to simply call mail(1)
+        sender = "irker@users.sourceforge.net"
+        smtp = smtplib.SMTP()
+        smtp.connect()
+        for request in requests:
+            msg = """From: %(sender)s
 Subject: irker json
 
-%(message)s""" % {"sender":sender, "message":message}
-                import smtplib
-                smtp = smtplib.SMTP()
-                smtp.connect()
-                smtp.sendmail(sender, extractor.email, msg)
-                smtp.quit()
-            elif extractor.tcp:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect((extractor.server or default_server, IRKER_PORT))
-                    sock.sendall(message + "\n")
-                finally:
-                    sock.close()
-            else:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    sock.sendto(message + "\n", (extractor.server or default_server, IRKER_PORT))
-                finally:
-                    sock.close()
-        except socket.error, e:
-            sys.stderr.write("%s\n" % e)
+%(message)s""" % {"sender":sender, "message":json.dumps(request)}
+            smtp.sendmail(sender, extractor.email, msg)
+        smtp.quit()
+        return
+    address = (extractor.server or default_server, IRKER_PORT)
+    if extractor.tcp:
+        limit = TCP_BATCH_MAX
+    else:
+        limit = UDP_BATCH_MAX
+    if extractor.batch:
+        lines = batches(requests, limit)
+    else:
+        lines = [json.dumps(request) for request in requests]
+    if extractor.tcp:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            sock.sendall("".join(line + "\n" for line in lines))
+        finally:
+            sock.close()
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line + "\n", address)
+        finally:
+            sock.close()
+
+def ship_all(extractor, commits, debug):
+    "Ship notifications for the specified commits, in order."
+    global urlcache
+    extractor.prefetch(commits)
+    coprocess = None
+    if extractor.filtercmd and extractor.filterstream:
+        coprocess = FilterProcess(extractor.filtercmd)
+    commits = [filtered(extractor, commit, coprocess) for commit in commits]
+    if coprocess:
+        coprocess.close()
+    path = extractor.urlcache
+    if not path or path.lower() == "none":
+        path = None
+    urlcache = URLCache(path and os.path.expanduser(path))
+    urlcache.resolve([(commit.webview(), commit.tinyifier)
+                      for commit in commits if commit.webview() is not None])
+    requests = []
+    for commit in commits:
+        request = notification(extractor, commit)
+        if debug:
+            print json.dumps(request)
+        elif request["to"]:
+            requests.append(request)
+    urlcache.save()
+    if not requests:
+        return
+    # Ready to ship.
+    try:
+        deliver(extractor, requests)
+    except (socket.error, smtplib.SMTPException), e:
+        sys.stderr.write("irkerhook.py: %d notification(s) not shipped: %s\n"
+                         % (len(requests), e))
+
+def ship(extractor, commit, debug):
+    "Ship a notification for the specified commit."
+    ship_all(extractor, [commit], debug)
 
 if __name__ == "__main__":
     notify = True
@@ -524,7 +866,6 @@ if __name__ == "__main__":
     # And apply it.
     if not commits:
         commits = [extractor.head()]
-    for commit in commits:
-        ship(extractor, commit, not notify)
+    ship_all(extractor, commits, not notify)
 
 #End